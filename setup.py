@@ -40,6 +40,8 @@ def main():
         author='Benjamin Schiller',
         author_email='ben.j.schiller@gmail.com',
         packages=['twobitreader'],
+        install_requires=['numpy'],
+        python_requires='>=3.4',
         package_data={'twobitreader': ['tests/test.2bit']},
         url='https://github.com/benjschiller/twobitreader',
         cmdclass=cmdclass,
@@ -56,11 +58,12 @@ def main():
             'Operating System :: MacOS :: MacOS X',
             'Operating System :: Microsoft :: Windows',
             'Operating System :: POSIX',
-            'Programming Language :: Python :: 2.7',
-            'Programming Language :: Python :: 3.2',
-            'Programming Language :: Python :: 3.3',
+            'Programming Language :: Python :: 3',
             'Programming Language :: Python :: 3.4',
             'Programming Language :: Python :: 3.5',
+            'Programming Language :: Python :: 3.6',
+            'Programming Language :: Python :: 3.7',
+            'Programming Language :: Python :: 3.8',
             'Topic :: Scientific/Engineering :: Bio-Informatics'
         ]
     )
@@ -1,14 +1,10 @@
-# Some of this test code is specific to 2.7
 import sys
 sys.path.insert(0, "..")
 import unittest
 import twobitreader
 import os
 import pickle
-if sys.version_info < (3,):
-    from cStringIO import StringIO
-else:
-    from io import BytesIO as StringIO
+from io import BytesIO
 
 
 class HasLongTypeTestCase(unittest.TestCase):
@@ -32,10 +28,28 @@ class ByteTableTestCase(unittest.TestCase):
 
     def test_polyNs(self):
         bt = self.byte_table
-        self.assertEqual(bt[0], ['T', 'T', 'T', 'T'])
-        self.assertEqual(bt[85], ['C', 'C', 'C', 'C'])
-        self.assertEqual(bt[170], ['A', 'A', 'A', 'A'])
-        self.assertEqual(bt[255], ['G', 'G', 'G', 'G'])
+        self.assertEqual(bt[0], b'TTTT')
+        self.assertEqual(bt[85], b'CCCC')
+        self.assertEqual(bt[170], b'AAAA')
+        self.assertEqual(bt[255], b'GGGG')
+
+    def test_mixed(self):
+        self.assertEqual(self.byte_table[27], b'TCAG')
+
+
+class TwoByteTableTestCase(unittest.TestCase):
+    def test_module_table(self):
+        self.assertEqual(len(twobitreader.TWOBYTE_TABLE), 2 ** 16)
+        bt = twobitreader.BYTE_TABLE
+        for x in [0, 27, 255, 256, 0x1be4, 0xffff]:
+            self.assertEqual(twobitreader.TWOBYTE_TABLE[x],
+                             bt[x >> 8] + bt[x & 0xff])
+
+    def test_create_twobyte_table(self):
+        d = twobitreader.create_twobyte_table()
+        self.assertEqual(len(d), 2 ** 16)
+        self.assertEqual(d[0x1be4], b'TCAGGACT')
+        self.assertEqual(d[0x1be4], twobitreader.TWOBYTE_TABLE[0x1be4])
 
 
 class SimpleBytesTestCase(unittest.TestCase):
@@ -45,12 +59,22 @@ class SimpleBytesTestCase(unittest.TestCase):
         self.assertEqual(twobitreader.bits_to_base(2), 'A')
         self.assertEqual(twobitreader.bits_to_base(3), 'G')
         self.assertRaises(ValueError, twobitreader.bits_to_base, 4)
+        self.assertRaises(ValueError, twobitreader.bits_to_base, -1)
+
+    def test_byte_to_bases(self):
+        self.assertEqual(twobitreader.byte_to_bases(0), b'TTTT')
+        self.assertEqual(twobitreader.byte_to_bases(27), b'TCAG')
+        self.assertEqual(twobitreader.byte_to_bases(228), b'GACT')
 
     def test_base_to_bin(self):
         self.assertEqual(twobitreader.base_to_bin('T'), '00')
         self.assertEqual(twobitreader.base_to_bin('C'), '01')
         self.assertEqual(twobitreader.base_to_bin('A'), '10')
         self.assertEqual(twobitreader.base_to_bin('G'), '11')
+        self.assertEqual(twobitreader.base_to_bin('TCAG'), '00011011')
+        self.assertRaises(ValueError, twobitreader.base_to_bin, 'N')
+        self.assertRaises(ValueError, twobitreader.base_to_bin, 'TCNG')
+        self.assertRaises(ValueError, twobitreader.base_to_bin, '')
 
 
 class SimpleLongsToCharTest(unittest.TestCase):
@@ -60,23 +84,60 @@ class SimpleLongsToCharTest(unittest.TestCase):
                                                      3797081033, 1243780212])
         self.as_string = \
             'TCTACCTAAGCGTAATGTTCCTCGCGTGGTAAGTACGCAGCCTAGATACGCTACCTTATACTAA'
-        self.chars_array = array(twobitreader._CHAR_CODE,
-                                 'TCTACCTAAGCGTAATGTTCCTCGCGTGGTAAGTACGCAGCCTAGATACGCTACCTTATACTAA')
+        self.as_bytes = self.as_string.encode('ascii')
 
     def test_longs_to_char(self):
         self.assertEqual(twobitreader.longs_to_char_array(self.longs_array,
-                                                          0, 16, 64),
-                         self.chars_array)
+                                                          0, 64),
+                         self.as_bytes)
 
     def test_longs_to_string(self):
-        as_string = twobitreader.safe_tostring(twobitreader.longs_to_char_array(self.longs_array,
-                                                                                0, 16, 64))
+        as_string = twobitreader.longs_to_char_array(self.longs_array,
+                                                     0, 64).decode('ascii')
         self.assertEqual(as_string, self.as_string)
 
+    def test_raw_bytes_input(self):
+        raw = self.longs_array.tobytes()
+        self.assertEqual(twobitreader.longs_to_char_array(raw, 0, 64),
+                         self.as_bytes)
+        # the input may end in a partial long
+        self.assertEqual(twobitreader.longs_to_char_array(raw[:11], 3, 40),
+                         self.as_bytes[3:43])
+
+    def test_out_buffer(self):
+        out = bytearray(40)
+        result = twobitreader.longs_to_char_array(self.longs_array, 3, 40,
+                                                  out=out)
+        self.assertTrue(result is out)
+        self.assertEqual(bytes(out), self.as_bytes[3:43])
+
+    def test_flags(self):
+        flags = bytearray(40)
+        flags[0:5] = b'\x04' * 5  # masked
+        flags[10:15] = b'\x08' * 5  # N
+        flags[12:20] = b'\x0c' * 8  # masked N
+        import numpy as np
+        result = twobitreader.longs_to_char_array(
+            self.longs_array, 3, 40,
+            flags=np.frombuffer(bytes(flags), dtype=np.uint8)
+        )
+        self.assertEqual(result, self.as_bytes[3:8].lower() +
+                         self.as_bytes[8:13] + b'NN' + b'nnnnnnnn' +
+                         self.as_bytes[23:43])
+
+    def test_flags_odd_byte_count(self):
+        import numpy as np
+        raw = self.longs_array.tobytes()[:7]
+        flags = np.zeros(25, dtype=np.uint8)
+        flags[-3:] = twobitreader.MASKED
+        result = twobitreader.longs_to_char_array(raw, 2, 25, flags=flags)
+        self.assertEqual(result, self.as_bytes[2:24] +
+                         self.as_bytes[24:27].lower())
+
     def test_string_length(self):
         for length in range(65):
             char_array = twobitreader.longs_to_char_array(self.longs_array,
-                                                          0, 16, length)
+                                                          0, length)
             self.assertEqual(len(char_array), length,
                              'Longs to character array conversion failed at length %d' %
                              length)
@@ -84,27 +145,46 @@ class SimpleLongsToCharTest(unittest.TestCase):
     def test_first_base_with_offsets(self):
         for offset in range(16):
             first_base = twobitreader.longs_to_char_array(self.longs_array,
-                                                          offset, 16, 1)[0]
-            self.assertEqual(first_base, self.chars_array[offset])
-            self.assertEqual(first_base, self.as_string[offset])
-
-    def test_first_base_with_offsets(self):
-        for offset in range(16):
-            first_base = twobitreader.longs_to_char_array(self.longs_array,
-                                                          offset, 16, 1)[0]
-            self.assertEqual(first_base, self.chars_array[offset],
-                             "Failed at offset %d" % offset)
-            self.assertEqual(first_base, self.as_string[offset],
+                                                          offset, 1)[0:1]
+            self.assertEqual(first_base, self.as_bytes[offset:offset + 1],
                              "Failed at offset %d" % offset)
 
     def test_last_base_with_offsets(self):
         for offset in reversed(range(1, 17)):
             last_base = twobitreader.longs_to_char_array(
                 self.longs_array,
-                0, offset, 64 - (16 - offset)
-            )[-1]
-            self.assertEqual(last_base, self.chars_array[-1 + (offset - 16)])
-            self.assertEqual(last_base, self.as_string[-1 + (offset - 16)])
+                0, 64 - (16 - offset)
+            )[-1:]
+            self.assertEqual(last_base,
+                             self.as_bytes[63 + (offset - 16):64 + (offset - 16)])
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, twobitreader.longs_to_char_array,
+                          self.longs_array, 0, 65)
+
+
+@unittest.skipIf(twobitreader.numba is None, 'numba not installed')
+class NumbaUnpackTest(unittest.TestCase):
+    def test_matches_numpy(self):
+        import numpy as np
+        packed = np.random.RandomState(0).randint(0, 256, 1000).astype(np.uint8)
+        for offset, size in [(0, 4000), (3, 3990), (15, 1)]:
+            codes = ((packed[:, None] >> twobitreader.SHIFTS) & 3).ravel()
+            codes = codes[offset:offset + size]
+            dna = np.empty(size, dtype=np.uint8)
+            twobitreader._unpack_numba(packed, twobitreader._NO_FLAGS, dna,
+                                       offset)
+            self.assertTrue((dna == twobitreader.BASES[codes]).all())
+            flags = np.random.RandomState(1).randint(0, 4, size) * 4
+            flags = flags.astype(np.uint8)
+            twobitreader._unpack_numba(packed, flags, dna, offset)
+            self.assertTrue((dna == twobitreader.BASES[codes | flags]).all())
+
+    def test_lock_only_for_workqueue(self):
+        import numba
+        twobitreader._warm_up_numba()
+        self.assertEqual(twobitreader._numba_thread_safe,
+                         numba.threading_layer() != 'workqueue')
 
 
 class BadTwoBitFileTest(unittest.TestCase):
@@ -130,6 +210,18 @@ class BadTwoBitFileTest(unittest.TestCase):
                           twobitreader.TwoBitFile,
                           self.t[1])
 
+    def test_open_truncated_file(self):
+        this_dir = os.path.dirname(__file__)
+        with open(os.path.join(this_dir, 'test.2bit'), 'rb') as f:
+            data = f.read()
+        # cut off in the index (ends at 107) and in the first sequence record
+        for size in (20, 33, 107, 111, 120, 130):
+            with open(self.t[1], 'wb') as f:
+                f.write(data[:size])
+            self.assertRaises(EOFError,
+                              twobitreader.TwoBitFile,
+                              self.t[1])
+
     def test_open_not_a_file(self):
         self.assertRaises(IOError,
                           twobitreader.TwoBitFile,
@@ -180,6 +272,14 @@ class CheckTestTwoBitFileTest(unittest.TestCase):
         self.assertEqual(chr1, 'GAACATGTACAACCTGACCTTCCACgaacatgtacaacctgaccttccacNNNNATGTACAACCTGACCTTCCAC')
         t.close()
 
+    def test_twobit_chr1_n_block(self):
+        t = twobitreader.TwoBitFile(self.filename)
+        chr1 = t['chr1']
+        self.assertEqual(chr1[50:54], 'NNNN')
+        self.assertEqual(chr1[51:53], 'NN')
+        self.assertEqual(chr1[49:55], 'cNNNNA')
+        t.close()
+
     def test_twobit_chr10_sequence(self):
         t = twobitreader.TwoBitFile(self.filename)
         chr10 = str(t['chr10'])
@@ -198,6 +298,9 @@ class CheckTestTwoBitFileTest(unittest.TestCase):
             found = t["chr10"].__getitem__(key)
             msg = "__getitem__[%s] failed. Expected %s, got %s" % (key, expected, found)
             self.assertEqual(found, expected, msg)
+        for key in [50, 75, 100, -51]:
+            with self.assertRaises(IndexError):
+                t["chr10"][key]
         t.close()
 
     def test_twobitsequence_getitem_slice(self):
@@ -208,17 +311,67 @@ class CheckTestTwoBitFileTest(unittest.TestCase):
                   (None, None, 'gaaagggaactccctgaccccttgtgaaagggaactccctgaccccttgt'),
                   (-10, -5, 'gaccc'),
                   (-5, None, 'cttgt'),
+                  (45, 100, 'cttgt'),
+                  (60, 100, ''),
+                  (10, 5, ''),
+                  (-50, -45, 'gaaag'),
                   ]
 
         for start, end, expected in slices:
             found = t["chr10"][start:end]
             self.assertEqual(found, expected,
                              "__getitem__ failed on [%s:%s]. Expected %s, got %s" % (start, end, expected, found))
+        with self.assertRaises(IndexError):
+            t["chr10"][-51:]
+        with self.assertRaises(IndexError):
+            t["chr10"][:-51]
+        t.close()
+
+    def test_get_slices(self):
+        t = twobitreader.TwoBitFile(self.filename)
+        intervals = [(0, 75), (20, 60), (5, 5), (70, 10), (-10, None),
+                     (48, 56), (0, 10), (None, None), (40, 200)]
+        for chrom in ['chr1', 'chr10']:
+            expected = [t[chrom][start:end] for start, end in intervals]
+            self.assertEqual(t[chrom].get_slices(intervals), expected)
+        self.assertEqual(t['chr1'].get_slices([]), [])
+        t.close()
+
+    def test_iter_slices(self):
+        t = twobitreader.TwoBitFile(self.filename)
+        chr1 = t['chr1']
+        self.assertEqual(list(chr1.iter_slices(chunk_size=30)),
+                         [chr1[0:30], chr1[30:60], chr1[60:75]])
+        self.assertEqual(list(chr1.iter_slices(10, -20, chunk_size=40)),
+                         [chr1[10:50], chr1[50:55]])
+        self.assertEqual(list(chr1.iter_slices(5, 5)), [])
+        from io import StringIO
+        stream = StringIO()
+        chr1.write_to(stream, chunk_size=16)
+        self.assertEqual(stream.getvalue(), str(chr1))
+        t.close()
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        t = twobitreader.TwoBitFile(self.filename)
+        regions = [(chrom, start, start + size) for chrom in t
+                   for start in range(0, 50, 7) for size in (1, 10, 30)]
+        expected = [t[chrom][start:end] for chrom, start, end in regions]
+        min_size = twobitreader.NUMBA_MIN_SIZE
+        try:
+            for twobitreader.NUMBA_MIN_SIZE in (min_size, 1):
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    found = list(executor.map(
+                        lambda region: t[region[0]][region[1]:region[2]],
+                        regions * 20))
+                self.assertEqual(found, expected * 20)
+        finally:
+            twobitreader.NUMBA_MIN_SIZE = min_size
         t.close()
 
     def test_pickle(self):
         t = twobitreader.TwoBitFile(self.filename)
-        buf = StringIO()
+        buf = BytesIO()
         pickle.dump(t,buf)
         buf.seek(0)
         t2 = pickle.load(buf)
@@ -233,11 +386,134 @@ class CheckTestTwoBitFileTest(unittest.TestCase):
             self.assertEqual(chr10,
                              'gaaagggaactccctgaccccttgtgaaagggaactccctgaccccttgt')
 
+    def test_twobit_reader(self):
+        import textwrap
+        t = twobitreader.TwoBitFile(self.filename)
+        bed = ['chr1\t0\t75\n', 'chr10 5 10\n', 'chr2\t0\t0\n',
+               'chr1 0 200\n', 'chrX 0 10\n']
+        expected = []
+        for chrom, start, end in [('chr1', 0, 75), ('chr10', 5, 10),
+                                  ('chr2', 0, 0), ('chr1', 0, 75)]:
+            expected.append('>%s:%d-%d' % (chrom, start, end))
+            expected.append(textwrap.fill(t[chrom][start:end], 60))
+        written = []
+        twobitreader.twobit_reader(t, input_stream=bed, write=written.append)
+        self.assertEqual(written, expected)
+        from io import StringIO
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            twobitreader.twobit_reader(t, input_stream=bed)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed, ''.join(x + '\n' for x in expected))
+        # long regions are written in chunks
+        chunk_size = twobitreader.STREAM_CHUNK_SIZE
+        twobitreader.STREAM_CHUNK_SIZE = 60
+        streamed = []
+        try:
+            twobitreader.twobit_reader(t, input_stream=bed,
+                                       write=streamed.append)
+            sys.stdout = StringIO()
+            twobitreader.twobit_reader(t, input_stream=bed)
+            printed = sys.stdout.getvalue()
+        finally:
+            twobitreader.STREAM_CHUNK_SIZE = chunk_size
+            sys.stdout = stdout
+        # write is called once per chunk instead of once per region
+        self.assertEqual(streamed[:3], [expected[0]] +
+                         expected[1].split('\n', 1))
+        self.assertTrue(max(len(x) for x in streamed) <= 60)
+        self.assertEqual(''.join(x + '\n' for x in streamed),
+                         ''.join(x + '\n' for x in expected))
+        self.assertEqual(printed, ''.join(x + '\n' for x in expected))
+        t.close()
+
     def test_closed_file(self):
         t = twobitreader.TwoBitFile(self.filename)
         t.close()
         with self.assertRaises(ValueError):
             chr1 = str(t['chr1'])
+        # also for a region inside an N block, which is not read from the file
+        with self.assertRaises(ValueError):
+            t['chr1'][50:54]
+
+    def test_overlapping_blocks(self):
+        """overlapping mask (or N) blocks mask (or N) their union once"""
+        import struct
+        import tempfile
+        bases = 'TCAG' * 8
+        packed = bytes(int(''.join('%d' % 'TCAG'.index(b) for b in
+                                   bases[k:k + 4]), 4)
+                       for k in range(0, len(bases), 4))
+        n_blocks = [(20, 4), (22, 4)]
+        mask_blocks = [(5, 7), (2, 6), (8, 1), (24, 4)]
+        record = struct.pack('<II', len(bases), len(n_blocks))
+        record += struct.pack('<%dI' % (2 * len(n_blocks)),
+                              *([s for s, _ in n_blocks] +
+                                [n for _, n in n_blocks]))
+        record += struct.pack('<I', len(mask_blocks))
+        record += struct.pack('<%dI' % (2 * len(mask_blocks)),
+                              *([s for s, _ in mask_blocks] +
+                                [n for _, n in mask_blocks]))
+        record += struct.pack('<I', 0) + packed
+        index = struct.pack('<B', 3) + b'seq' + struct.pack('<I', 16 + 8)
+        data = struct.pack('<IIII', 0x1A412743, 0, 1, 0) + index + record
+        handle, filename = tempfile.mkstemp(suffix='.2bit')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            expected = (bases[:2] + bases[2:12].lower() + bases[12:20] +
+                        'NNNN' + 'nn' + bases[26:28].lower() + bases[28:])
+            with twobitreader.TwoBitFile(filename) as t:
+                self.assertEqual(str(t['seq']), expected)
+                for start, end in [(3, 10), (21, 25), (22, 26), (0, 32)]:
+                    self.assertEqual(t['seq'][start:end],
+                                     expected[start:end])
+        finally:
+            os.remove(filename)
+
+    def test_byteswapped_file(self):
+        """a file written on a machine of the other byte order"""
+        import struct
+        import tempfile
+        with open(self.filename, 'rb') as f:
+            data = bytearray(f.read())
+        native = '<' if sys.byteorder == 'little' else '>'
+        swapped = '>' if native == '<' else '<'
+
+        def swap(position, count=1):
+            # swap count 32-bit fields, returns them and the next position
+            fmt = '%dI' % count
+            values = struct.unpack_from(native + fmt, data, position)
+            struct.pack_into(swapped + fmt, data, position, *values)
+            return values, position + 4 * count
+
+        (_, _, sequence_count, _), position = swap(0, 4)
+        offsets = []
+        for _ in range(sequence_count):
+            position += 1 + data[position]
+            (offset,), position = swap(position)
+            offsets.append(offset)
+        for position in offsets:
+            (_, n_block_count), position = swap(position, 2)
+            _, position = swap(position, 2 * n_block_count)
+            (mask_block_count,), position = swap(position)
+            _, position = swap(position, 2 * mask_block_count + 1)
+        # the packed DNA itself is a byte stream and stays as it is
+        handle, filename = tempfile.mkstemp(suffix='.2bit')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            with twobitreader.TwoBitFile(self.filename) as expected:
+                with twobitreader.TwoBitFile(filename) as t:
+                    self.assertTrue(t['chr1']._byteswapped)
+                    for name in expected:
+                        self.assertEqual(str(t[name]), str(expected[name]))
+                        self.assertEqual(t[name][13:41],
+                                         expected[name][13:41])
+        finally:
+            os.remove(filename)
 
 if __name__ == '__main__':
     unittest.main()
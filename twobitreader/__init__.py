@@ -5,47 +5,22 @@ Licensed under Perl Artistic License 2.0
 No warranty is provided, express or implied
 """
 from array import array
-from bisect import bisect_right
 from errno import ENOENT, EACCES
-from os import R_OK, access
-
-try:
-    from os import strerror
-except ImportError:
-    strerror = lambda x: 'strerror not supported'
+from functools import lru_cache
+from os import R_OK, access, strerror
 from os.path import exists, getsize
 import logging
-import textwrap
+import mmap
+import struct
 import sys
+import threading
 
-at_least_py3 = at_least_py32 = False
-if sys.version_info > (3,):
-    at_least_py3 = True
-if sys.version_info > (3,2):
-    at_least_py32 = True
-
-if at_least_py3:
-    izip = zip
-    xrange = range
-    _CHAR_CODE = 'u'
-    iteritems = dict.items
-    long = int
-else:
-    from itertools import izip
-
-    _CHAR_CODE = 'c'
-    iteritems = dict.iteritems
-
-
-def safe_tostring(ary):
-    """
-    convert arrays to strings in a Python 2.x / 3.x safe way
-    """
-    if at_least_py3:
-        return ary.tounicode().encode("ascii").decode()
-    else:
-        return ary.tostring()
+import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
 def true_long_type():
     """
@@ -64,52 +39,43 @@ as equivalent to LONG")
 LONG = true_long_type()
 
 
+# the two bases encoded by each 4-bit value
+_NIBBLE = [a + b for a in (b'T', b'C', b'A', b'G')
+           for b in (b'T', b'C', b'A', b'G')]
+
+
 def byte_to_bases(x):
-    """convert one byte to the four bases it encodes"""
-    c = (x >> 4) & 0xf
-    f = x & 0xf
-    cc = (c >> 2) & 0x3
-    cf = c & 0x3
-    fc = (f >> 2) & 0x3
-    ff = f & 0x3
-    return [bits_to_base(X) for X in (cc, cf, fc, ff)]
+    """convert one byte to the four bases it encodes (as bytes)"""
+    return _NIBBLE[(x >> 4) & 0xf] + _NIBBLE[x & 0xf]
 
 
 def bits_to_base(x):
     """convert integer representation of two bits to correct base"""
-    if x is 0:
-        return 'T'
-    elif x is 1:
-        return 'C'
-    elif x is 2:
-        return 'A'
-    elif x is 3:
-        return 'G'
-    else:
+    if not x in range(4):
         raise ValueError('Only integers 0-3 are valid inputs')
+    return 'TCAG'[x]
+
+
+# translation table from bases to their bit representation
+BASE_TO_BIN = str.maketrans({'T': '00', 'C': '01', 'A': '10', 'G': '11'})
 
 
 def base_to_bin(x):
     """
     provided for user convenience
-    convert a nucleotide to its bit representation
-    """
-    if x == 'T':
-        return '00'
-    elif x == 'C':
-        return '01'
-    elif x == 'A':
-        return '10'
-    elif x == 'G':
-        return '11'
-    else:
+    convert a nucleotide (or a sequence of them) to its bit representation
+    """
+    bits = x.translate(BASE_TO_BIN)
+    # anything but 'ATGC' is left as a single character
+    if not x or len(bits) != 2 * len(x):
         raise ValueError('Only characters \'ATGC\' are valid inputs')
+    return bits
 
 
 def create_byte_table():
-    """create BYTE_TABLE"""
+    """create BYTE_TABLE (maps each byte to the four bases it encodes, as bytes)"""
     d = {}
-    for x in xrange(2 ** 8):
+    for x in range(2 ** 8):
         d[x] = byte_to_bases(x)
     return d
 
@@ -125,96 +91,255 @@ def split16(x):
 
 
 def create_twobyte_table():
-    """create TWOBYTE_TABLE"""
+    """
+    create a dict mapping two bytes to the eight bases they encode
+    (the same as TWOBYTE_TABLE, which is an array)
+    """
     d = {}
-    for x in xrange(2 ** 16):
+    for x in range(2 ** 16):
         c, f = split16(x)
-        d[x] = list(byte_to_bases(c)) + list(byte_to_bases(f))
+        d[x] = BYTE_TABLE[c] + BYTE_TABLE[f]
     return d
 
 
 BYTE_TABLE = create_byte_table()
-TWOBYTE_TABLE = create_twobyte_table()
 
-
-def longs_to_char_array(longs, first_base_offset, last_base_offset, array_size,
-                        more_bytes=None):
+# lookup tables for the vectorized decoder in longs_to_char_array
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+# indexed by a 2-bit code plus MASKED and/or N_BLOCK
+BASES = np.frombuffer(b'TCAGtcagNNNNnnnn', dtype=np.uint8)
+MASKED = 4
+N_BLOCK = 8
+# the four bases (as ASCII) and their 2-bit codes for each byte value
+BYTE_BASES = np.frombuffer(b''.join([BYTE_TABLE[x] for x in range(2 ** 8)]),
+                           dtype=np.uint8).reshape(2 ** 8, 4)
+BYTE_CODES = (np.arange(2 ** 8, dtype=np.uint8)[:, None] >> SHIFTS) & 3
+# the eight bases for each pair of bytes (first byte in the high bits),
+# TWOBYTE_TABLE[x] is bytes like BYTE_TABLE[x], TWOBYTE_BASES is its ASCII
+TWOBYTE_BASES = np.concatenate((np.repeat(BYTE_BASES, 2 ** 8, axis=0),
+                                np.tile(BYTE_BASES, (2 ** 8, 1))), axis=1)
+TWOBYTE_TABLE = TWOBYTE_BASES.view('|S8').ravel()
+# the eight 2-bit codes for each pair of bytes packed into one (native) 64-bit
+# word, a gather of whole words is much faster than one of 8-byte rows
+TWOBYTE_CODE_WORDS = np.concatenate((np.repeat(BYTE_CODES, 2 ** 8, axis=0),
+                                     np.tile(BYTE_CODES, (2 ** 8, 1))),
+                                    axis=1).view(np.uint64).ravel()
+
+
+def longs_to_char_array(longs, first_base_offset, array_size, out=None,
+                        flags=None):
     """
-    takes in an array of longs (4 bytes) and converts them to bases in
-    a char array
-    you must also provide the offset in the first and last block
-    (note these offsets are pythonic. last_offset is not included)
-    and the desired array_size
-    If you have less than a long worth of bases at the end, you can provide
-    them as a string with more_bytes=
-
-    NOTE: last_base_offset is inside more_bytes not the last long, if more_bytes
-          is not None
-    returns the correct subset of the array based on provided offsets
+    takes in an array of longs (4 bytes) or their raw bytes (e.g. a uint8
+    array or memoryview) and converts them to bases
+    you must also provide the offset of the first base in the first long
+    and the desired array_size (the input may end in a partial long)
+    returns the correct subset of the bases (as bytes) based on provided offsets
+    If out= is given (a bytearray of at least array_size), the bases are
+    written into it instead and it is returned
+    flags= (a uint8 array of array_size) can mark each base as MASKED (lower
+    case) and/or N_BLOCK (N), these are applied while decoding
     """
     if array_size == 0:
-        return array(_CHAR_CODE)
+        return b'' if out is None else out
     elif array_size < 0:
         raise ValueError('array_size must be at least 0')
 
     if not first_base_offset in range(16):
         raise ValueError('first_base_offset must be in range(16)')
-    if not last_base_offset in range(1, 17):
-        raise ValueError('last_base_offset must be in range(1, 17)')
 
-    longs_len = len(longs)
-    if more_bytes is None:
-        shorts_length = 0
+    # view the packed DNA as bytes (no copy), 2-bit files store it as a
+    # plain byte stream regardless of their byte order
+    if len(longs) > 0:
+        packed = np.frombuffer(longs, dtype=np.uint8)
     else:
-        shorts_length = len(more_bytes)
-    if array_size > longs_len * 16 + 4 * shorts_length:
+        packed = np.empty(0, dtype=np.uint8)
+    if first_base_offset + array_size > len(packed) * 4:
         raise ValueError('array_size exceeds maximum possible for input')
 
-    dna = array(_CHAR_CODE, 'N' * (longs_len * 16 + 4 * shorts_length))
-    # translate from 32-bit blocks to bytes
-    # this method ensures correct endianess (byteswap as neeed)
-    i = 0
-    if longs_len > 0:
-        bytes_ = array('B')
-        if at_least_py32:
-            bytes_.frombytes(longs.tobytes())
-        else:
-            bytes_.fromstring(longs.tostring())
-        # first block
-        first_block = ''.join([''.join(BYTE_TABLE[bytes_[x]]) for x in range(4)])
-        i = 16 - first_base_offset
-        if array_size < i:
-            i = array_size
-        dna[0:i] = array(_CHAR_CODE, first_block[first_base_offset:first_base_offset + i])
-    if longs_len > 1:
-        # middle blocks (implicitly skipped if they don't exist)
-        for byte in bytes_[4:-4]:
-            dna[i:i + 4] = array(_CHAR_CODE, BYTE_TABLE[byte])
-            i += 4
-        # last block
-        last_block = array(_CHAR_CODE, ''.join([''.join(BYTE_TABLE[bytes_[x]])
-                                                for x in range(-4, 0)]))
-        if more_bytes is None:
-            dna[i:i + last_base_offset] = last_block[0:last_base_offset]
-        else:  # if there are more bytes, we need the whole last block
-            dna[i:i + 16] = last_block[0:16]
-        i += 16
-    if more_bytes is not None:
-        bytes_ = array('B')
-        if at_least_py32:
-            bytes_.frombytes(more_bytes)
+    if out is None:
+        dna = np.empty(array_size, dtype=np.uint8)
+    else:
+        dna = np.frombuffer(out, dtype=np.uint8, count=array_size)
+    if _unpack_numba is not None and array_size >= NUMBA_MIN_SIZE:
+        _warm_up_numba()
+        if _numba_thread_safe:
+            _unpack_numba(packed, _NO_FLAGS if flags is None else flags, dna,
+                          first_base_offset)
         else:
-            bytes_.fromstring(more_bytes)
-        j = i
-        for byte in bytes_:
-            j = i + 4
-            if j > array_size:
-                dnabytes = array(_CHAR_CODE, BYTE_TABLE[byte])[0:(array_size - i)]
-                dna[i:array_size] = dnabytes
-                break
-            dna[i:i + last_base_offset] = array(_CHAR_CODE, BYTE_TABLE[byte])
-            i += 4
-    return dna[0:array_size]
+            with _NUMBA_LOCK:
+                _unpack_numba(packed, _NO_FLAGS if flags is None else flags,
+                              dna, first_base_offset)
+    elif flags is None:
+        # look up the eight bases of every pair of bytes at once (a single
+        # gather), and the four bases of an odd last byte
+        even_size = len(packed) - len(packed) % 2
+        bases = np.empty(len(packed) * 4, dtype=np.uint8)
+        np.take(TWOBYTE_BASES, packed[:even_size].view('>u2'), axis=0,
+                out=bases[:even_size * 4].reshape(-1, 8))
+        if even_size < len(packed):
+            bases[even_size * 4:] = BYTE_BASES[packed[-1]]
+        dna[:] = bases[first_base_offset:first_base_offset + array_size]
+    else:
+        # look up the eight 2-bit codes of every pair of bytes as one word
+        # (and the four codes of an odd last byte), keep only the requested
+        # ones and look up the (flagged) bases
+        even_size = len(packed) - len(packed) % 2
+        words = np.empty((len(packed) + 1) // 2, dtype=np.uint64)
+        np.take(TWOBYTE_CODE_WORDS, packed[:even_size].view('>u2'),
+                out=words[:even_size // 2])
+        codes = words.view(np.uint8)
+        if even_size < len(packed):
+            codes[even_size * 4:len(packed) * 4] = BYTE_CODES[packed[-1]]
+        codes = codes[first_base_offset:first_base_offset + array_size]
+        codes |= flags
+        np.take(BASES, codes, out=dna)
+    if out is None:
+        return dna.tobytes()
+    return out
+
+
+# long regions (e.g. whole chromosomes) are decoded by a parallel numba
+# kernel if numba is installed, shorter ones aren't worth the thread overhead
+NUMBA_MIN_SIZE = 2 ** 20
+_NO_FLAGS = np.empty(0, dtype=np.uint8)
+# numba's workqueue threading layer (its fallback if neither tbb nor OpenMP
+# is available) aborts on concurrent parallel launches, so these are only
+# serialized if numba ends up using it (known after the first launch)
+_NUMBA_LOCK = threading.Lock()
+_numba_thread_safe = None
+
+if numba is not None:
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _unpack_numba(packed, flags, dna, first_base_offset):
+        """
+        decode len(dna) bases from the uint8 array packed (starting at
+        first_base_offset) as ASCII into the uint8 array dna, applying
+        flags unless it is empty
+        """
+        masked = len(flags) > 0
+        for i in numba.prange(len(dna)):
+            j = i + first_base_offset
+            code = (packed[j >> 2] >> (6 - 2 * (j & 3))) & 3
+            if masked:
+                code |= flags[i]
+            dna[i] = BASES[code]
+
+    def _warm_up_numba():
+        """
+        compile (or load from the cache) and run the numba kernel once, so
+        that numba has picked its threading layer
+        """
+        global _numba_thread_safe
+        if _numba_thread_safe is None:
+            with _NUMBA_LOCK:
+                # packed DNA is a read-only view of the memory map
+                _unpack_numba(np.frombuffer(b'\x00', dtype=np.uint8),
+                              _NO_FLAGS, np.empty(4, dtype=np.uint8), 0)
+                _numba_thread_safe = numba.threading_layer() != 'workqueue'
+else:
+    _unpack_numba = None
+
+    def _warm_up_numba():
+        pass
+
+
+# struct byte order prefixes for fields written by a machine with the same
+# (native) or the other (swapped) endianness, see TwoBitFile._load_header
+_NATIVE = '<' if sys.byteorder == 'little' else '>'
+_SWAPPED = '>' if _NATIVE == '<' else '<'
+
+
+def _endian(byteswapped):
+    """returns the struct/numpy byte order prefix for a 2-bit file"""
+    return _SWAPPED if byteswapped else _NATIVE
+
+
+def _check_size(mm, end, what):
+    """raises EOFError if mm ends before end (where what ends)"""
+    if end > len(mm):
+        raise EOFError('File is too short to contain %s' % what)
+
+
+def _read_blocks(mm, offset, block_count, long_dtype):
+    """
+    read the block_count starts and then the block_count sizes of N or mask
+    blocks at offset in mm, returns the starts and ends as int64 arrays
+    (these are copies, so no views of mm outlive get_slice)
+    Overlapping or adjacent blocks are merged (and empty ones dropped), so
+    the returned blocks are sorted and disjoint
+    """
+    starts = np.frombuffer(mm, dtype=long_dtype, count=block_count,
+                           offset=offset).astype(np.int64)
+    sizes = np.frombuffer(mm, dtype=long_dtype, count=block_count,
+                          offset=offset + 4 * block_count).astype(np.int64)
+    nonempty = sizes > 0
+    order = np.argsort(starts[nonempty], kind='stable')
+    starts = starts[nonempty][order]
+    ends = starts + sizes[nonempty][order]
+    if len(starts) == 0:
+        return starts, ends
+    # a block starts a new merged block unless it begins at or before the
+    # furthest end of the blocks before it, a merged block ends at the
+    # furthest end up to its last block
+    furthest_end = np.maximum.accumulate(ends)
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > furthest_end[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], furthest_end[last]
+
+
+def _overlapping_blocks(starts, ends, min_, max_):
+    """
+    takes the (sorted) starts and ends of N or mask blocks as numpy arrays
+    and returns the index range lo, hi of the blocks overlapping min_:max_
+    (min_ and max_ may also be arrays, to look up many regions at once)
+    """
+    return (np.searchsorted(ends, min_, side='right'),
+            np.searchsorted(starts, max_, side='left'))
+
+
+def _covered(starts, ends, blocks, min_, max_):
+    """
+    returns whether a single one of the blocks (an index range lo, hi)
+    covers all of min_:max_
+    """
+    lo, hi = blocks
+    return hi - lo == 1 and starts[lo] <= min_ and ends[lo] >= max_
+
+
+def _add_block_edges(delta, starts, ends, lo, hi, min_, max_, flag):
+    """
+    adds flag to delta at the start and subtracts it at the end of each of
+    the blocks lo:hi (clipped to min_:max_ and relative to min_)
+    returns whether there were any such blocks
+    """
+    if lo >= hi:
+        return False
+    np.add.at(delta, np.clip(starts[lo:hi], min_, max_) - min_, flag)
+    np.add.at(delta, np.clip(ends[lo:hi], min_, max_) - min_, -flag)
+    return True
+
+
+@lru_cache(maxsize=4096)
+def _normalize_range(min_, max_, dna_size):
+    """
+    turns slice coordinates (possibly negative or None) of a sequence of
+    dna_size bases into the region min_:max_ to decode, (0, 0) if it is empty
+    (cached, as e.g. reads often hit the same regions many times)
+    """
+    if min_ is None:  # for slicing e.g. [:]
+        min_ = 0
+    if max_ is None:
+        max_ = dna_size
+    if min_ < -dna_size or max_ < -dna_size:
+        raise IndexError('index out of range')
+    # handle negative coordinates and truncate at the end of the sequence
+    min_ += dna_size * (min_ < 0)
+    max_ = min(max_ + dna_size * (max_ < 0), dna_size)
+    # make sure there's a proper range
+    if min_ >= max_:
+        return 0, 0
+    return min_, max_
 
 
 class TwoBitFile(dict):
@@ -245,19 +370,24 @@ TwoBitFile is also a context manager:
 """
 
     def __init__(self, foo):
-        super(TwoBitFile, self).__init__()
-        self._file_handle = None  # for __del__ if checks fail
+        super().__init__()
+        self._mm = None  # for __del__ if checks fail
         if not exists(foo):
-            raise IOError(ENOENT, strerror(ENOENT), foo)
+            raise OSError(ENOENT, strerror(ENOENT), foo)
         if not access(foo, R_OK):
-            raise IOError(EACCES, strerror(EACCES), foo)
+            raise OSError(EACCES, strerror(EACCES), foo)
         self._filename = foo
         self._file_size = getsize(foo)
-        self._file_handle = open(foo, 'rb')
-        self._load_header()
+        _warm_up_numba()
+        # everything is read through a read-only memory map of the file, it
+        # holds no file position, so sequences can be read from many threads
+        with open(foo, 'rb') as file_handle:
+            self._load_header(file_handle.read(16))
+            self._mm = mmap.mmap(file_handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
         self._load_index()
-        for name, offset in iteritems(self._offset_dict):
-            self[name] = TwoBitSequence(self._file_handle, offset,
+        for name, offset in self._offset_dict.items():
+            self[name] = TwoBitSequence(self._mm, offset,
                                         self._file_size,
                                         self._byteswapped)
         return
@@ -271,27 +401,27 @@ TwoBitFile is also a context manager:
     def close(self):
         """close the underlying two-bit file"""
         # attempts to access after this results in a ValueError
-        self._file_handle.close()
+        self._mm.close()
 
     def __del__(self):
-        if self._file_handle is not None:
+        if self._mm is not None:
             self.close()
 
     def __reduce__(self): # enables pickling
         return (TwoBitFile,(self._filename,))
 
-    def _load_header(self):
-        file_handle = self._file_handle
-        header = array(LONG)
-        header.fromfile(file_handle, 4)
+    def _load_header(self, header):
+        if len(header) < 16:
+            raise EOFError('File is too short to contain a 2-bit header')
         # check signature -- must be 0x1A412743
         # if not, swap bytes
         byteswapped = False
-        (signature, version, sequence_count, reserved) = header
+        (signature, version, sequence_count,
+         reserved) = struct.unpack(_NATIVE + 'IIII', header)
         if not signature == 0x1A412743:
             byteswapped = True
-            header.byteswap()
-            (signature2, version, sequence_count, reserved) = header
+            (signature2, version, sequence_count,
+             reserved) = struct.unpack(_SWAPPED + 'IIII', header)
             if not signature2 == 0x1A412743:
                 raise TwoBitFileError('Signature in header should be ' +
                                       '0x1A412743, instead found 0x%X' %
@@ -302,30 +432,25 @@ TwoBitFile is also a context manager:
             raise TwoBitFileError('Reserved field in header should be 0.')
         self._byteswapped = byteswapped
         self._sequence_count = sequence_count
+        # all other 32-bit fields are read in the byte order found here
+        self._u32 = struct.Struct(_endian(byteswapped) + 'I')
 
     def _load_index(self):
-        file_handle = self._file_handle
-        byteswapped = self._byteswapped
+        mm = self._mm
+        u32 = self._u32
         remaining = self._sequence_count
         sequence_offsets = []
-        file_handle.seek(16)
+        position = 16
         while remaining > 0:
-            name_size = array('B')
-            name_size.fromfile(file_handle, 1)
-            if byteswapped:
-                name_size.byteswap()
-            # name = array(_CHAR_CODE)
-            name = array('B')
-            name.fromfile(file_handle, name_size[0])
-            name = "".join([chr(X) for X in name])
-
-            if byteswapped:
-                name.byteswap()
-            offset = array(LONG)
-            offset.fromfile(file_handle, 1)
-            if byteswapped:
-                offset.byteswap()
-            sequence_offsets.append((name, offset[0]))
+            _check_size(mm, position + 1, 'the index')
+            name_size = mm[position]
+            position += 1
+            _check_size(mm, position + name_size + 4, 'the index')
+            name = mm[position:position + name_size].decode('latin-1')
+            position += name_size
+            offset, = u32.unpack_from(mm, position)
+            position += 4
+            sequence_offsets.append((name, offset))
             remaining -= 1
         self._sequence_offsets = sequence_offsets
         self._offset_dict = dict(sequence_offsets)
@@ -333,21 +458,17 @@ TwoBitFile is also a context manager:
     def sequence_sizes(self):
         """returns a dictionary with the sizes of each sequence"""
         d = {}
-        file_handle = self._file_handle
-        byteswapped = self._byteswapped
-        for name, offset in iteritems(self._offset_dict):
-            file_handle.seek(offset)
-            dna_size = array(LONG)
-            dna_size.fromfile(file_handle, 1)
-            if byteswapped:
-                dna_size.byteswap()
-            d[name] = dna_size[0]
+        mm = self._mm
+        u32 = self._u32
+        for name, offset in self._offset_dict.items():
+            d[name], = u32.unpack_from(mm, offset)
         return d
 
 
 class TwoBitSequence(object):
     """
 A TwoBitSequence object refers to an entry in a TwoBitFile
+(it reads from the memory map of the file, given as mm)
 
 You may access intervals by slicing or using str() to dump the entire entry
 e.g.
@@ -374,48 +495,36 @@ d = x.dict()
 for k,v in d.items(): d[k] = str(v)
     """
 
-    def __init__(self, file_handle, offset, file_size, byteswapped=False):
+    def __init__(self, mm, offset, file_size, byteswapped=False):
         self._file_size = file_size
-        self._file_handle = file_handle
+        self._mm = mm
         self._original_offset = offset
         self._byteswapped = byteswapped
-        file_handle.seek(offset)
-        header = array(LONG)
-        header.fromfile(file_handle, 2)
-        if byteswapped:
-            header.byteswap()
-        dna_size, n_block_count = header
+        endian = _endian(byteswapped)
+        _check_size(mm, offset + 8, 'the sequence record')
+        dna_size, n_block_count = struct.unpack_from(endian + 'II', mm, offset)
         self._dna_size = dna_size  # number of characters, 2 bits each
-        self._n_bytes = (dna_size + 3) / 4  # number of bytes
+        self._n_bytes = (dna_size + 3) // 4  # number of bytes
         # number of 32-bit fragments
-        self._packed_dna_size = (dna_size + 15) / 16
-        n_block_starts = array(LONG)
-        n_block_sizes = array(LONG)
-        n_block_starts.fromfile(file_handle, n_block_count)
-        if byteswapped:
-            n_block_starts.byteswap()
-        n_block_sizes.fromfile(file_handle, n_block_count)
-        if byteswapped:
-            n_block_sizes.byteswap()
-        self._n_block_starts = n_block_starts
-        self._n_block_sizes = n_block_sizes
-        mask_rawc = array(LONG)
-        mask_rawc.fromfile(file_handle, 1)
-        if byteswapped:
-            mask_rawc.byteswap()
-        mask_block_count = mask_rawc[0]
-        mask_block_starts = array(LONG)
-        mask_block_starts.fromfile(file_handle, mask_block_count)
-        if byteswapped:
-            mask_block_starts.byteswap()
-        mask_block_sizes = array(LONG)
-        mask_block_sizes.fromfile(file_handle, mask_block_count)
-        if byteswapped:
-            mask_block_sizes.byteswap()
-        self._mask_block_starts = mask_block_starts
-        self._mask_block_sizes = mask_block_sizes
-        file_handle.read(4)
-        self._offset = file_handle.tell()
+        self._packed_dna_size = (dna_size + 15) // 16
+        long_dtype = np.dtype(endian + 'u4')
+        position = offset + 8
+        _check_size(mm, position + 8 * n_block_count + 4,
+                    'the sequence record')
+        # block boundaries as sorted numpy arrays for lookups in get_slice
+        self._n_starts, self._n_ends = _read_blocks(mm, position,
+                                                    n_block_count, long_dtype)
+        position += 8 * n_block_count
+        mask_block_count, = struct.unpack_from(endian + 'I', mm, position)
+        position += 4
+        _check_size(mm, position + 8 * mask_block_count + 4,
+                    'the sequence record')
+        self._mask_starts, self._mask_ends = _read_blocks(mm, position,
+                                                          mask_block_count,
+                                                          long_dtype)
+        position += 8 * mask_block_count
+        # skip the reserved field
+        self._offset = position + 4
 
     def __len__(self):
         return self._dna_size
@@ -432,6 +541,8 @@ for k,v in d.items(): d[k] = str(v)
             return self.get_slice(min_=slice_or_key.start, max_=slice_or_key.stop)
 
         elif isinstance(slice_or_key, int):
+            if slice_or_key >= len(self):
+                raise IndexError('index out of range')
             max_ = slice_or_key + 1
             if max_ == 0:
                 max_ = None
@@ -441,124 +552,140 @@ for k,v in d.items(): d[k] = str(v)
         """
         get_slice returns only a sub-sequence
         """
-        # handle negative coordinates
-        dna_size = self._dna_size
-        if min_ is None:  # for slicing e.g. [:]
-            min_ = 0
-        if max_ is not None and max_ < 0:
-            if max_ < -dna_size:
-                raise IndexError('index out of range')
-            max_ = dna_size + max_
-        if min_ is not None and min_ < 0:
-            if min_ < -dna_size:
-                raise IndexError('index out of range')
-            min_ = dna_size + min_
-        # make sure there's a proper range
-        if max_ is not None and min_ > max_:
-            return ''
-        if max_ == 0 or max_ == min_:
+        min_, max_ = self._normalize(min_, max_)
+        if min_ == max_:
             return ''
+        return self._decode(min_, max_)
+
+    def get_slices(self, intervals):
+        """
+        get_slices returns the sub-sequences for a list of (start, end)
+        intervals (in the same order)
+        The N and mask blocks of all intervals are looked up at once, so this
+        is faster than calling get_slice for each of many intervals
+        (e.g. the regions of a BED file)
+        """
+        regions = [self._normalize(min_, max_) for min_, max_ in intervals]
+        if not regions:
+            return []
+        mins = np.array([min_ for min_, max_ in regions], dtype=np.int64)
+        maxs = np.array([max_ for min_, max_ in regions], dtype=np.int64)
+        mask_los, mask_his = _overlapping_blocks(self._mask_starts,
+                                                 self._mask_ends, mins, maxs)
+        n_los, n_his = _overlapping_blocks(self._n_starts, self._n_ends,
+                                           mins, maxs)
+        slices = []
+        for (min_, max_), mask_lo, mask_hi, n_lo, n_hi in zip(
+                regions, mask_los.tolist(), mask_his.tolist(),
+                n_los.tolist(), n_his.tolist()):
+            if min_ == max_:
+                slices.append('')
+            else:
+                slices.append(self._decode(min_, max_, (mask_lo, mask_hi),
+                                           (n_lo, n_hi)))
+        return slices
+
+    def iter_slices(self, min_=None, max_=None, chunk_size=2 ** 20):
+        """
+        iter_slices yields the sub-sequence min_:max_ (by default the whole
+        sequence) as consecutive strings of chunk_size bases, so that long
+        regions never have to be in memory at once
+        """
+        min_, max_ = self._normalize(min_, max_)
+        for start in range(min_, max_, chunk_size):
+            yield self._decode(start, min(start + chunk_size, max_))
 
-        # load all the data
-        if max_ is None or max_ > dna_size:
-            max_ = dna_size
+    def write_to(self, stream, chunk_size=2 ** 20):
+        """
+        writes the entire sequence to stream (a text file-like object)
+        chunk_size bases at a time
+        """
+        for chunk in self.iter_slices(chunk_size=chunk_size):
+            stream.write(chunk)
 
-        file_handle = self._file_handle
-        byteswapped = self._byteswapped
-        n_block_starts = self._n_block_starts
-        n_block_sizes = self._n_block_sizes
-        mask_block_starts = self._mask_block_starts
-        mask_block_sizes = self._mask_block_sizes
-        offset = self._offset
-        packed_dna_size = self._packed_dna_size
-        # n_bytes = self._n_bytes
+    def _normalize(self, min_, max_):
+        """
+        turns slice coordinates (possibly negative or None) into the
+        region min_:max_ to decode, (0, 0) if it is empty
+        """
+        return _normalize_range(min_, max_, self._dna_size)
+
+    def _decode(self, min_, max_, mask_blocks=None, n_blocks=None):
+        """
+        returns the bases in min_:max_ as a string
+        mask_blocks and n_blocks are the index ranges of the overlapping
+        blocks, if they are already known
+        """
+        # fail like reading the map would, also for regions not read from it
+        if self._mm.closed:
+            raise ValueError('mmap closed or invalid')
+        if mask_blocks is None:
+            mask_blocks = _overlapping_blocks(self._mask_starts,
+                                              self._mask_ends, min_, max_)
+        if n_blocks is None:
+            n_blocks = _overlapping_blocks(self._n_starts, self._n_ends,
+                                           min_, max_)
+        # regions inside a single N block (e.g. gaps or centromeres) are
+        # all N, there is nothing to read or decode
+        if _covered(self._n_starts, self._n_ends, n_blocks, min_, max_):
+            if mask_blocks[0] >= mask_blocks[1]:
+                return 'N' * (max_ - min_)
+            if _covered(self._mask_starts, self._mask_ends, mask_blocks,
+                        min_, max_):
+                return 'n' * (max_ - min_)
 
         # region_size is how many bases the region is
-        if max_ is None:
-            region_size = dna_size - min_
-        else:
-            region_size = max_ - min_
+        region_size = max_ - min_
 
         # start_block, end_block are the first/last 32-bit blocks we need
         # blocks start at 0
         start_block = min_ // 16
         # jump directly to desired file location
-        local_offset = offset + (start_block * 4)
+        local_offset = self._offset + (start_block * 4)
         end_block = (max_ - 1 + 16) // 16
-        # don't read past seq end
-
-        file_handle.seek(local_offset)
-
-        # note we won't actually read the last base
-        # this is a python slice first_base_offset:16*blocks+last_base_offset
+        # the region starts at this base of the first block
         first_base_offset = min_ % 16
-        last_base_offset = max_ % 16
-        if last_base_offset == 0:
-            last_base_offset = 16
-        # +1 we still need to read end_block maybe
-        blocks_to_read = end_block - start_block
-        if (blocks_to_read + start_block) > packed_dna_size:
-            blocks_to_read = packed_dna_size - start_block
-
-        fourbyte_dna = array(LONG)
-        # remainder_seq = None
-        if (blocks_to_read * 4 + local_offset) > self._file_size:
-            fourbyte_dna.fromfile(file_handle, blocks_to_read - 1)
-            morebytes = file_handle.read()  # read the remaining characters
-        #            if byteswapped:
-        #                morebytes = ''.join(reversed(morebytes))
-        else:
-            fourbyte_dna.fromfile(file_handle, blocks_to_read)
-            morebytes = None
-        if byteswapped:
-            fourbyte_dna.byteswap()
-        str_as_array = longs_to_char_array(fourbyte_dna, first_base_offset,
-                                           last_base_offset, region_size,
-                                           more_bytes=morebytes)
-        for start, size in izip(n_block_starts, n_block_sizes):
-            end = start + size
-            if end <= min_:
-                continue
-            if start > max_:
-                break
-            if start < min_:
-                start = min_
-            if end > max_:
-                end = max_
-            start -= min_
-            end -= min_
-            # this should actually be decoded, 00=N, 01=n
-            str_as_array[start:end] = array(_CHAR_CODE, 'N' * (end - start))
-        lower = str.lower
-        first_masked_region = max(0,
-                                  bisect_right(mask_block_starts, min_) - 1)
-        last_masked_region = min(len(mask_block_starts),
-                                 1 + bisect_right(mask_block_starts, max_,
-                                                  lo=first_masked_region))
-        for start, size in izip(mask_block_starts[first_masked_region:
-        last_masked_region],
-                                mask_block_sizes[first_masked_region:
-                                last_masked_region]):
-            end = start + size
-            if end <= min_:
-                continue
-            if start > max_:
-                break
-            if start < min_:
-                start = min_
-            if end > max_:
-                end = max_
-            start -= min_
-            end -= min_
-            str_as_array[start:end] = array(_CHAR_CODE,
-                                            lower(safe_tostring(str_as_array[start:end])))
-        if not len(str_as_array) == max_ - min_:
+
+        # view the packed DNA in the memory map directly (no copy), the last
+        # block may be cut short at the end of the file
+        n_bytes = min((end_block - start_block) * 4,
+                      self._file_size - local_offset)
+        packed = np.frombuffer(self._mm, dtype=np.uint8, count=n_bytes,
+                               offset=local_offset)
+        dna = bytearray(region_size)
+        longs_to_char_array(packed, first_base_offset, region_size, out=dna,
+                            flags=self._flags(min_, max_, mask_blocks,
+                                              n_blocks))
+        if not len(dna) == max_ - min_:
             raise RuntimeError("Sequence was the wrong size")
-        return safe_tostring(str_as_array)
+        return dna.decode('ascii')
+
+    def _flags(self, min_, max_, mask_blocks, n_blocks):
+        """
+        returns the flags (see longs_to_char_array) marking masked and N
+        bases in min_:max_, or None if there are none
+        mask_blocks and n_blocks are the index ranges of the overlapping
+        blocks
+        """
+        # the running sum over the block edges is the sum of the flags of
+        # the blocks covering each base (blocks of one kind are merged in
+        # _read_blocks, so at most one of each covers a base)
+        region_size = max_ - min_
+        delta = np.zeros(region_size + 1, dtype=np.int8)
+        masked = _add_block_edges(delta, self._mask_starts, self._mask_ends,
+                                  mask_blocks[0], mask_blocks[1],
+                                  min_, max_, MASKED)
+        n_block = _add_block_edges(delta, self._n_starts, self._n_ends,
+                                   n_blocks[0], n_blocks[1],
+                                   min_, max_, N_BLOCK)
+        if not (masked or n_block):
+            return None
+        return np.cumsum(delta[:region_size], dtype=np.int8).view(np.uint8)
 
     def __str__(self):
         """
         returns the entire chromosome
+        (see write_to or iter_slices to avoid holding it in memory)
         """
         return self.get_slice(0, None)
 
@@ -570,7 +697,7 @@ class TwoBitFileError(Exception):
 
     def __init__(self, msg):
         errtext = 'Invalid 2-bit file. ' + msg
-        return super(TwoBitFileError, self).__init__(errtext)
+        return super().__init__(errtext)
 
 
 def print_specification():
@@ -669,6 +796,14 @@ def cmdline_reader():
     twobit_reader(twobit_file, input_stream=sys.stdin)
 
 
+# line length of FASTA output
+FASTA_WIDTH = 60
+# maximum number of BED regions twobit_reader extracts at once
+BATCH_SIZE = 10000
+# longer regions are extracted and written in chunks of this size
+STREAM_CHUNK_SIZE = FASTA_WIDTH * 2 ** 14
+
+
 def twobit_reader(twobit_file, input_stream=None, write=None):
     """
     twobit_reader takes a twobit_file (of class TwoBitFile)
@@ -688,44 +823,97 @@ def twobit_reader(twobit_file, input_stream=None, write=None):
     warning_msg = 'Invalid %s at line %d\n\t"%s"'
     if input_stream is None:
         return
+    # consecutive regions on the same chrom are extracted together
+    batch_chrom = None
+    batch = []
     for i, line in enumerate((line.rstrip('\n\r') for line in input_stream)):
         fields = line.split()
         if not len(fields) >= 3:
-            logging.warn(warning_msg, 'start', i, line)
+            logging.warning(warning_msg, 'start', i, line)
             continue
         chrom = fields[0]
         if not chrom in twobit_file:
-            logging.warn(warning_msg, 'chrom', i, line)
+            logging.warning(warning_msg, 'chrom', i, line)
             continue
         try:
-            start = long(fields[1])
+            start = int(fields[1])
         except ValueError:
-            logging.warn(warning_msg, 'start', i, line)
+            logging.warning(warning_msg, 'start', i, line)
         if start < 0:
-            logging.warn(warning_msg, 'start', i, line)
-            logging.warn('Using 0 as start instead for line %d', i)
+            logging.warning(warning_msg, 'start', i, line)
+            logging.warning('Using 0 as start instead for line %d', i)
             start = 0
         try:
-            end = long(fields[2])
+            end = int(fields[2])
         except ValueError:
-            logging.warn(warning_msg, 'end', i, line)
+            logging.warning(warning_msg, 'end', i, line)
             continue
         chrom_len = len(twobit_file[chrom])
         if end > len(twobit_file[chrom]):
-            logging.warn('At line %d, end is greater than chrom length %d\n%s',
+            logging.warning('At line %d, end is greater than chrom length %d\n%s',
                          i, chrom_len, line)
-            logging.warn('Sequence will be truncated at chrom' +
+            logging.warning('Sequence will be truncated at chrom' +
                          'length for line %d', i)
             end = chrom_len
-        seq = twobit_file[chrom][start:end]
-        if write is not None:
-            write(">%s:%d-%d" % (chrom, start, end))
-            write(textwrap.fill(seq, 60))
-        else:
-            print(">%s:%d-%d" % (chrom, start, end))
-            print(textwrap.fill(seq, 60))
+        if chrom != batch_chrom or len(batch) >= BATCH_SIZE:
+            _write_fasta(twobit_file, batch_chrom, batch, write)
+            batch_chrom = chrom
+            batch = []
+        if end - start > STREAM_CHUNK_SIZE:
+            _write_fasta(twobit_file, batch_chrom, batch, write)
+            batch = []
+            chunks = twobit_file[chrom].iter_slices(start, end,
+                                                    STREAM_CHUNK_SIZE)
+            _write_fasta_record(chrom, start, end, chunks, write)
+            continue
+        batch.append((start, end))
+    _write_fasta(twobit_file, batch_chrom, batch, write)
     return
 
 
+def _write_fasta(twobit_file, chrom, intervals, write=None):
+    """
+    writes the regions of chrom given by intervals (a list of (start, end)
+    pairs) in FASTA format using write (print if write=None)
+    """
+    if not intervals:
+        return
+    seqs = twobit_file[chrom].get_slices(intervals)
+    for (start, end), seq in zip(intervals, seqs):
+        _write_fasta_record(chrom, start, end, [seq], write)
+
+
+def _write_fasta_record(chrom, start, end, chunks, write=None):
+    """
+    writes one region in FASTA format using write (print if write=None)
+    its sequence is given as chunks, all but the last of which must be a
+    multiple of FASTA_WIDTH long
+    write is called once per (non-empty) chunk with its lines, so only one
+    chunk is held in memory at a time
+    """
+    header = ">%s:%d-%d" % (chrom, start, end)
+    if write is not None:
+        write(header)
+        empty = True
+        for seq in chunks:
+            if seq:
+                empty = False
+                write('\n'.join([seq[k:k + FASTA_WIDTH]
+                                 for k in range(0, len(seq), FASTA_WIDTH)]))
+        if empty:
+            write('')
+        return
+    stdout = sys.stdout
+    stdout.write(header + '\n')
+    empty = True
+    for seq in chunks:
+        if seq:
+            empty = False
+        stdout.writelines(seq[k:k + FASTA_WIDTH] + '\n'
+                          for k in range(0, len(seq), FASTA_WIDTH))
+    if empty:
+        stdout.write('\n')
+
+
 if __name__ == '__main__':
     cmdline_reader()
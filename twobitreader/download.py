@@ -8,13 +8,7 @@ and do not over-use this module
 
 By default, genomes are saved to the current directory
 """
-import sys
-
-if sys.version_info > (3,):
-    from urllib.request import urlopen
-else:
-    from urllib2 import urlopen
-
+from urllib.request import urlopen
 from shutil import copyfileobj
 from os.path import exists, join
 from os import getcwd